@@ -5,14 +5,49 @@
 
 #define EP_TERMSPEC "unix socket terminal"
 
+/* GET_CAPS flags */
+#define CAP_CRC 0x01 /* packets end with a CRC-16/XMODEM, little-endian */
+#define CAP_SEQ 0x02 /* SEND_PTY is numbered and acknowledged by GET_KEYS */
+#define CAP_ALL (CAP_CRC | CAP_SEQ)
+
 // interface
 extern unsigned char has_recv_char();
 
+/* CRC16: CRC-16/XMODEM (poly 0x1021, init 0) of "len" bytes at "p".
+ */
+unsigned int crc16(unsigned char *p, int len) {
+  unsigned int crc = 0;
+  int i;
+
+  while (len--) {
+    crc ^= (unsigned int)*(p++) << 8;
+    for (i = 0; i < 8; i++)
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc & 0xffff;
+}
+
+/* SEND_REPLY: sends the "len" bytes at "p", appending the CRC trailer
+ * if "caps" has CAP_CRC; "p" must have room for two more bytes.
+ */
+void send_reply(unsigned char *p, int len, unsigned char caps) {
+  unsigned int crc;
+
+  if (caps & CAP_CRC) {
+    crc = crc16(p, len);
+    p[len++] = crc & 0xff;
+    p[len++] = crc >> 8;
+  }
+  send_packet(p, len);
+}
+
 int mainloop() {
   unsigned char buff[128];
   unsigned char kbd[64];
   unsigned char *p, *kbd_p;
   int l, i, c;
+  unsigned char seq = 0;
+  unsigned char caps = 0; /* flags the host has opted into */
 
   kbd_p = kbd;
 
@@ -32,26 +67,50 @@ int mainloop() {
     if (l == 0)
       continue;
 
+    /* with CAP_CRC every packet but GET_CAPS carries a CRC, drop
+     * corrupted or truncated ones
+     */
+    if ((caps & CAP_CRC) && !(buff[0] == 0x00 && buff[1] == 0x00)) {
+      if (l < 4 || crc16(buff, l - 2) !=
+                     (buff[l - 2] | ((unsigned int)buff[l - 1] << 8)))
+        continue;
+      l -= 2;
+    }
+
     if (buff[0] == 0x00 && buff[1] == 0x00) {
+      /* the host lists the flags it supports, a bare GET_CAPS none */
+      caps = l > 2 ? buff[2] & CAP_ALL : 0;
       p = buff + 2;
       strncpy((char *)p, EP_TERMSPEC, sizeof(EP_TERMSPEC));
-      send_packet(buff, 2 + sizeof(EP_TERMSPEC));
+      p += sizeof(EP_TERMSPEC);
+      /* largest packet we can receive, little-endian */
+      *(p++) = sizeof(buff) & 0xff;
+      *(p++) = sizeof(buff) >> 8;
+      *(p++) = caps;
+      send_packet(buff, p - buff);
     }
     if (buff[0] == 0x01 && buff[1] == 0x01) {
       p = buff + 2;
+      /* last displayed SEND_PTY, then the keystrokes */
+      if (caps & CAP_SEQ)
+        *(p++) = seq;
       i = kbd_p - kbd;
       strncpy((char *)p, (char *)kbd, i);
-      send_packet(buff, i + 2);
+      send_reply(buff, p - buff + i, caps);
       kbd_p = kbd;
     }
     if (buff[0] == 0x02 && buff[1] == 0x02) {
       putchar(0x1B);
       putchar("k"[0]);
-      for (i = 2; i < l; i++)
+      i = 2;
+      if (caps & CAP_SEQ)
+        seq = buff[i++];
+      for (; i < l; i++)
         putchar(buff[i]);
       putchar(0x1B);
       putchar("j"[0]);
-      send_packet(buff, 2);
+      if (!(caps & CAP_SEQ))
+        send_reply(buff, 2, caps);
     }
     if (buff[0] == 0x03 && buff[1] == 0x03) {
       puts("SIGINT");
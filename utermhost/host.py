@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 
 import argparse
+import binascii
 import collections
 import fcntl
 import io
+import itertools
 import logging
 import os
 import pty
@@ -15,7 +17,7 @@ import struct
 import termios
 import time
 from enum import Enum
-from typing import Deque, Union
+from typing import Callable, Deque, Optional, Union
 
 import serial
 
@@ -24,12 +26,51 @@ logger: logging.Logger = logging.getLogger(__name__)
 
 TConn = Union[socket.socket, serial.Serial]
 
+# rfc1055 SLIP special character codes
+_END = b"\xc0"  # 0o300 indicates end of packet
+_ESC = b"\xdb"  # 0o333 indicates byte stuffing
+_ESC_END = b"\xdc"  # 0o334 ESC ESC_END means END data byte
+_ESC_ESC = b"\xdd"  # 0o335 ESC ESC_ESC means ESC data byte
+_ESCAPED_END = _ESC + _ESC_END
+_ESCAPED_ESC = _ESC + _ESC_ESC
+
 
 def set_winsize(fd, row, col, xpix=0, ypix=0):
     winsize = struct.pack("HHHH", row, col, xpix, ypix)
     fcntl.ioctl(fd, termios.TIOCSWINSZ, winsize)
 
 
+def slip_encode(data: bytes) -> bytes:
+    """
+    rfc1055 SLIP framing of a single packet
+    """
+    # most packets have nothing to escape and are framed as they are
+    if data.find(_ESC) >= 0:
+        data = data.replace(_ESC, _ESCAPED_ESC)
+    if data.find(_END) >= 0:
+        data = data.replace(_END, _ESCAPED_END)
+    return b"".join((_END, data, _END))
+
+
+def append_crc(data: bytes) -> bytes:
+    """
+    appends CRC-16/XMODEM of the packet, little-endian
+    """
+    return data + struct.pack("<H", binascii.crc_hqx(data, 0))
+
+
+def strip_crc(data: bytes) -> Optional[bytes]:
+    """
+    returns the packet without its CRC trailer, or None if it doesn't match
+    """
+    if len(data) < 2:
+        return None
+    payload, (crc,) = data[:-2], struct.unpack("<H", data[-2:])
+    if binascii.crc_hqx(payload, 0) != crc:
+        return None
+    return payload
+
+
 class Direction(Enum):
     UND = 0
     IN = 1
@@ -42,19 +83,42 @@ class HostController(object):
     SEND_PTY = b"\x02\x02"
     SIG_INT = b"\x03\x03"
 
-    # rfc1055 SLIP special character codes
-    END = b"\xc0"  # 0o300 indicates end of packet
-    ESC = b"\xdb"  # 0o333 indicates byte stuffing
-    ESC_END = b"\xdd"  # 0o334 ESC ESC_END means END data byte
-    ESC_ESC = b"\xde"  # 0o335 ESC ESC_ESC means ESC data byte
+    END = _END
+    ESC = _ESC
+    ESC_END = _ESC_END
+    ESC_ESC = _ESC_ESC
+
+    # GET_CAPS flags
+    # GET_CAPS and its reply never carry a CRC, so either side can restart
+    CAP_CRC = 0x01
+    CAP_SEQ = 0x02
+    # offered in GET_CAPS, the remote only uses the flags it was offered
+    HOST_CAPS = CAP_CRC | CAP_SEQ
+
+    # control packets never change, so are framed once
+    _GET_CAPS_FRAME = slip_encode(GET_CAPS + bytes((HOST_CAPS,)))
+    _GET_KEYS_FRAME = slip_encode(GET_KEYS)
+    _SIG_INT_FRAME = slip_encode(SIG_INT)
 
     BUFSIZE = 92
+    MAX_BUFSIZE = 1024
+    WINDOW = 1
+    IOV_MAX = 1024
     IO_TIMEOUT = 5
+    RECV_CHUNK = 4096
 
     _conn: TConn
     _scr: io.BytesIO
     _kbd: Deque[bytes]
-    _pty: Deque[bytes]
+    _pty: bytearray
+    _unacked: Deque[int]
+    _rxbuf: bytearray
+    _ptybuf: memoryview
+    _rxpos: int = 0
+    _inflight: int = 0
+    _crc: bool = False
+    _piggyback: bool = False
+    _seq: int = 0
     _fd: int = -1
     _enabled = False
 
@@ -64,27 +128,32 @@ class HostController(object):
         self._conn = conn
         self._scr = io.BytesIO()
         self._kbd = collections.deque()
-        self._pty = collections.deque()
+        self._pty = bytearray()
+        self._unacked = collections.deque()
+        self._rxbuf = bytearray()
+        self._ptybuf = memoryview(bytearray(2048))
         self._sel = selectors.DefaultSelector()
 
     def _handle_pty(self, conn: int, mask: int) -> None:
         try:
             if mask & selectors.EVENT_READ:
-                buf = bytearray(2048)
-                l = os.readv(self._fd, [buf])
+                l = os.readv(self._fd, [self._ptybuf])
                 if l > 0:
-                    self._pty.extend(buf[:l])  # type: ignore
+                    self._pty += self._ptybuf[:l]
 
             if mask & selectors.EVENT_WRITE:
                 if not self._kbd:
                     return
-                buf = bytes(self._kbd)  # type: ignore
-                l = os.writev(self._fd, [buf])
+                l = os.writev(self._fd, list(itertools.islice(self._kbd, self.IOV_MAX)))
                 # termios.tcdrain(self._fd)
-                if l == len(self._kbd):
-                    self._kbd.clear()
-                else:
-                    raise RuntimeError
+                while l:
+                    chunk = self._kbd.popleft()
+                    if len(chunk) > l:
+                        self._kbd.appendleft(chunk[l:])
+                        break
+                    l -= len(chunk)
+                if not self._kbd:
+                    self._watch_pty(selectors.EVENT_READ)
         except OSError:
             self.signal_int()
             raise SystemExit
@@ -94,11 +163,17 @@ class HostController(object):
             raise RuntimeError
         set_winsize(fd, 24, 51)
         os.set_blocking(fd, False)
-        self._sel.register(
-            fd, selectors.EVENT_READ | selectors.EVENT_WRITE, self._handle_pty
-        )
+        self._sel.register(fd, selectors.EVENT_READ, self._handle_pty)
         self._fd = fd
 
+    def _watch_pty(self, events: int) -> None:
+        """
+        the pty is writable nearly always, so EVENT_WRITE is only watched
+        while there are keystrokes to write
+        """
+        if self._sel.get_key(self._fd).events != events:
+            self._sel.modify(self._fd, events, self._handle_pty)
+
     def send(self, data: bytes) -> None:
         raise NotImplemented
 
@@ -109,43 +184,62 @@ class HostController(object):
         """
         rfc1055 SLIP send_packet
         """
-        logger.debug(">>>---")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(">>>---")
+        self.set_watchdog()
+        crc = self._crc and not data.startswith(self.GET_CAPS)
+        self.send(slip_encode(append_crc(data) if crc else data))
+        if debug:
+            logger.debug(">>> %s", data)
+
+    def _send_control(self, frame: bytes) -> None:
         self.set_watchdog()
-        self.send(
-            self.END
-            + data.replace(self.ESC, self.ESC + self.ESC_ESC).replace(
-                self.END, self.ESC + self.ESC_END
-            )
-            + self.END
-        )
-        logger.debug(">>> %s", data)
+        self.send(frame)
+
+    def _fill_rxbuf(self) -> int:
+        """
+        appends up to RECV_CHUNK bytes from the connection to the receive
+        buffer, dropping already consumed bytes first;
+        returns the number of unconsumed bytes that were already buffered
+        """
+        self.set_watchdog()
+        chunk = self.recv(self.RECV_CHUNK)
+        if len(chunk) == 0:
+            raise SystemExit
+        del self._rxbuf[: self._rxpos]
+        self._rxpos = 0
+        pending = len(self._rxbuf)
+        self._rxbuf += chunk
+        return pending
 
     def recv_packet(self) -> bytes:
         """
         rfc1055 SLIP recv_packet
         """
-        received = io.BytesIO()
-        logger.debug("<<<---")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("<<<---")
         while True:
-            self.set_watchdog()
-            char = self.recv(1)
-            if len(char) == 0:
-                raise SystemExit
-            if char == self.END:
-                if received.tell() != 0:
-                    data = received.getvalue()
+            end = self._rxbuf.find(_END, self._rxpos)
+            while end < 0:
+                scanned = self._fill_rxbuf()
+                end = self._rxbuf.find(_END, scanned)
+            start, self._rxpos = self._rxpos, end + 1
+            if end > start:
+                with memoryview(self._rxbuf) as view:
+                    data = bytes(view[start:end])
+                if _ESC in data:
+                    data = data.replace(_ESCAPED_END, _END).replace(_ESCAPED_ESC, _ESC)
+                if self._crc and not data.startswith(self.GET_CAPS):
+                    payload = strip_crc(data)
+                    if payload is None:
+                        logger.warning("dropping corrupted packet: %s", data)
+                        continue
+                    data = payload
+                if debug:
                     logger.debug("<<< %s", data)
-                    return data
-            elif char == self.ESC:
-                esc_char = self.recv(1)
-                if esc_char == self.ESC_ESC:
-                    received.write(self.ESC)
-                elif esc_char == self.ESC_END:
-                    received.write(self.END)
-                else:
-                    received.write(esc_char)
-            else:
-                received.write(char)
+                return data
 
     @classmethod
     def from_socket(cls, path: str) -> "HostController":
@@ -160,20 +254,73 @@ class HostController(object):
         conn = serial.Serial(path, rtscts=True)  # type: ignore
         return SerialHostController(conn)
 
+    def enable_crc(self) -> None:
+        self._crc = True
+        self._GET_KEYS_FRAME = slip_encode(append_crc(self.GET_KEYS))
+        self._SIG_INT_FRAME = slip_encode(append_crc(self.SIG_INT))
+
+    def get_caps(self) -> bytes:
+        self._send_control(self._GET_CAPS_FRAME)
+        recv = self.recv_packet()
+        if recv.startswith(self.GET_CAPS):
+            return recv[2:]
+        return b""
+
     def get_keys(self) -> bytes:
-        self.send_packet(self.GET_KEYS)
+        self._send_control(self._GET_KEYS_FRAME)
         recv = self.recv_packet()
         if recv.startswith(self.GET_KEYS):
+            if self._piggyback:
+                if len(recv) < 3:
+                    return b""
+                self._ack_pty(recv[2])
+                return recv[3:]
             return recv[2:]
         return b""
 
     def send_pty(self, data: bytes) -> None:
+        """
+        sends a pty chunk, keeping up to WINDOW chunks unacknowledged;
+        with CAP_SEQ the chunk is numbered and acknowledged by GET_KEYS
+        """
+        if self._piggyback:
+            self._seq = (self._seq + 1) & 0xFF
+            self.send_packet(self.SEND_PTY + bytes((self._seq,)) + data)
+            self._unacked.append(self._seq)
+            return
         self.send_packet(self.SEND_PTY + data)
+        self._inflight += 1
+        while self._inflight >= self.WINDOW:
+            self._recv_ack()
+
+    def wait_pty(self) -> None:
+        while self._inflight:
+            self._recv_ack()
+
+    def _recv_ack(self) -> None:
         self.recv_packet()
+        self._inflight -= 1
+
+    def can_send_pty(self) -> bool:
+        """
+        checks that fewer than WINDOW pty chunks await acknowledgement
+        """
+        return len(self._unacked) < self.WINDOW
+
+    def _ack_pty(self, seq: int) -> None:
+        """
+        retires the pty chunks up to seq, or all of them if seq is unknown
+        """
+        if seq in self._unacked:
+            while self._unacked.popleft() != seq:
+                pass
+        elif self._unacked:
+            logger.warning("remote lost %d pty chunks", len(self._unacked))
+            self._unacked.clear()
 
     def signal_int(self) -> None:
         logger.info("resetting remote side")
-        self.send_packet(self.SIG_INT)
+        self._send_control(self._SIG_INT_FRAME)
 
     def disable(self) -> None:
         self._enabled = False
@@ -183,28 +330,53 @@ class HostController(object):
         if self._enabled:
             signal.alarm(self.IO_TIMEOUT)
 
+    def negotiate(self) -> None:
+        """
+        agrees on frame size and protocol flags with the remote
+        """
+        termspec, _, caps = self.get_caps().partition(b"\x00")
+        logger.info("remote: %s", termspec.decode())
+        flags = caps[2] & self.HOST_CAPS if len(caps) >= 3 else 0
+        if flags & self.CAP_CRC:
+            self.enable_crc()
+            logger.info("remote checks crc")
+        if flags & self.CAP_SEQ:
+            self._piggyback = True
+            logger.info("remote acknowledges pty with keystrokes")
+        if len(caps) >= 2:
+            # remote advertises the largest packet it can receive
+            (frame,) = struct.unpack_from("<H", caps)
+            overhead = len(self.SEND_PTY) + (2 if self._crc else 0)
+            overhead += 1 if self._piggyback else 0
+            if frame > overhead:
+                self.BUFSIZE = min(frame - overhead, self.MAX_BUFSIZE)
+                logger.info("remote frame size: %d", frame)
+            else:
+                logger.warning("ignoring remote frame size: %d", frame)
+
     def serve(self) -> None:
-        self.send_packet(self.GET_CAPS)
-        logger.info("remote: %s", self.recv_packet()[2:].strip(b"\x00").decode())
+        self.negotiate()
 
         self._enabled = True
         while self._enabled:
-            for key, mask in self._sel.select():
+            # never block here, the GET_KEYS round trip paces the loop
+            for key, mask in self._sel.select(timeout=0):
                 callback = key.data
                 callback(key.fileobj, mask)
 
             keystrokes = self.get_keys()
             if keystrokes:
-                self._kbd.extend(keystrokes)  # type: ignore
+                self._kbd.append(keystrokes)
+                self._watch_pty(selectors.EVENT_READ | selectors.EVENT_WRITE)
                 logger.info("received keystrokes: %s", keystrokes)
                 continue
 
-            while self._pty:
-                data = bytes(self._pty)  # type: ignore
-                self.send_pty(data[: self.BUFSIZE])
-                self._pty.clear()
-                self._pty.extend(data[self.BUFSIZE :])  # type: ignore
+            while self._pty and self.can_send_pty():
+                data = bytes(self._pty[: self.BUFSIZE])
+                self.send_pty(data)
+                del self._pty[: self.BUFSIZE]
                 logger.info("sent pty: %s", data)
+            self.wait_pty()
 
         self.signal_int()
 
@@ -212,8 +384,19 @@ class HostController(object):
 class SocketHostController(HostController):
     _conn: socket.socket
 
+    SOCK_BUFSIZE = 262144
+    WINDOW = 4
+
+    def __init__(self, conn: TConn) -> None:
+        super(SocketHostController, self).__init__(conn)
+        self._conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCK_BUFSIZE)
+        self._conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCK_BUFSIZE)
+        if self._conn.family in (socket.AF_INET, socket.AF_INET6):
+            # every frame is a complete request or reply, don't let Nagle hold it
+            self._conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     def send(self, data: bytes) -> None:
-        self._conn.send(data)
+        self._conn.sendall(data)
 
     def recv(self, buffersize: int) -> bytes:
         return self._conn.recv(buffersize)
@@ -223,23 +406,33 @@ class SerialHostController(HostController):
     _conn: serial.Serial
     _last_direction: Direction
 
+    # upper bound for the line to settle on a direction change
     SWAP_DELAY = 0.1
+    SWAP_POLL = 0.001
 
     def __init__(self, conn: TConn) -> None:
         super(SerialHostController, self).__init__(conn)
         self._last_direction = Direction.UND
 
+    def _wait_line(self, ready: Callable[[], bool]) -> None:
+        deadline = time.monotonic() + self.SWAP_DELAY
+        while not ready() and time.monotonic() < deadline:
+            time.sleep(self.SWAP_POLL)
+
     def send(self, data: bytes) -> None:
         if self.SWAP_DELAY and self._last_direction != Direction.OUT:
-            time.sleep(self.SWAP_DELAY)
+            # remote raises RTS (our CTS) once it is listening again
+            self._wait_line(lambda: self._conn.cts)
             self._last_direction = Direction.OUT
         self._conn.write(data)
 
     def recv(self, buffersize: int) -> bytes:
         if self.SWAP_DELAY and self._last_direction != Direction.IN:
-            time.sleep(self.SWAP_DELAY)
+            # let the last frame leave the UART before turning around
+            self._conn.flush()
             self._last_direction = Direction.IN
-        return self._conn.read(buffersize)
+        # read whatever is already buffered, blocking for at least one byte
+        return self._conn.read(min(buffersize, self._conn.in_waiting or 1))
 
 
 def setup_shell(terminal: str) -> None:
@@ -287,6 +480,8 @@ def main(debug: bool = False) -> None:
         ctrl = HostController.from_socket(args.device)
 
     if args.reset:
+        # SIG_INT has to be framed the way the remote expects
+        ctrl.negotiate()
         ctrl.signal_int()
         raise SystemExit
 
@@ -308,7 +503,7 @@ def main(debug: bool = False) -> None:
             logger.warning("timeout, trying to recover")
             # logger.warning("timeout, graceful shutdown")
             # ctrl.signal_int()
-            ctrl.send_packet(ctrl.GET_CAPS)
+            ctrl.send_packet(ctrl.GET_CAPS + bytes((ctrl.HOST_CAPS,)))
             ctrl.graceful = True
         else:
             logger.error("timeout")